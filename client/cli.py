@@ -3,13 +3,90 @@ import requests
 import hashlib
 import os
 import argparse
+import json
 
 NAMENODE = os.environ.get("NAMENODE_URL", "http://namenode:8000")
-BLOCK_SIZE = int(os.environ.get("BLOCK_SIZE", 64*1024))  #64 KB 
+BLOCK_SIZE = int(os.environ.get("BLOCK_SIZE", 0))  # 0 = automático (lo sugiere el NameNode)
+# Tabla de montaje para repartir el namespace entre varios NameNodes (JSON en línea o ruta a un .json).
+# Sin tabla todo va a NAMENODE, como siempre.
+MOUNT_TABLE = os.environ.get("MOUNT_TABLE", "")
 
 def sha256(b: bytes) -> str:
     return hashlib.sha256(b).hexdigest()
 
+# --- Tabla de montaje (sharding del namespace) -------------------------
+# {
+#   "mounts": {"/user/demo": "http://nn1:8000"},           prefijo -> NameNode (gana el más largo)
+#   "hash_prefix": "/user",                                 subárboles /user/{x} repartidos por hash de x
+#   "hash_namenodes": ["http://nn1:8000", "http://nn2:8000"],
+#   "default": "http://namenode:8000"                       todo lo demás
+# }
+def load_mount_table(spec):
+    if not spec:
+        return {}
+    if spec.lstrip().startswith("{"):
+        return json.loads(spec)
+    with open(spec) as f:
+        return json.load(f)
+
+MOUNTS = load_mount_table(MOUNT_TABLE)
+
+def norm_path(path):
+    return "/" + path.strip("/")
+
+def mount_prefixes():
+    return [(norm_path(p), url) for p, url in MOUNTS.get("mounts", {}).items()]
+
+def hash_prefix():
+    return norm_path(MOUNTS.get("hash_prefix", "/user"))
+
+def namenode_for(path):
+    """NameNode (shard) dueño de `path` según la tabla de montaje."""
+    path = norm_path(path)
+    best = None
+    for prefix, url in mount_prefixes():
+        if (path == prefix or path.startswith(prefix.rstrip("/") + "/")) and (best is None or len(prefix) > len(best[0])):
+            best = (prefix, url)
+    if best:
+        return best[1]
+    shards = MOUNTS.get("hash_namenodes")
+    base = hash_prefix().rstrip("/") + "/"
+    if shards and path.startswith(base):
+        key = path[len(base):].split("/")[0]
+        return shards[int(hashlib.sha1(key.encode()).hexdigest(), 16) % len(shards)]
+    return MOUNTS.get("default", NAMENODE)
+
+def namenodes_under(path):
+    """NameNodes que pueden tener entradas bajo `path` (un ls puede cruzar varios shards)."""
+    path = norm_path(path)
+    base = path.rstrip("/") + "/"
+    urls = [namenode_for(path)]
+    urls += [url for prefix, url in mount_prefixes() if prefix.startswith(base)]
+    if (hash_prefix().rstrip("/") + "/").startswith(base):
+        urls += MOUNTS.get("hash_namenodes", [])
+    if path == "/":
+        urls.append(MOUNTS.get("default", NAMENODE))
+    return list(dict.fromkeys(urls))
+
+def all_namenodes():
+    return namenodes_under("/")
+
+def list_path(path, user="", password=""):
+    """ls sobre todos los shards implicados; une y ordena los resultados."""
+    files = {}
+    for nn in namenodes_under(path):
+        try:
+            r = requests.get(f"{nn}/namenode/ls", params={"path": path, "user": user, "password": password})
+        except requests.RequestException as e:
+            print(f"Error ({nn}):", e)
+            continue
+        if r.status_code != 200:
+            print(f"Error ({nn}):", r.text)
+            continue
+        for f in r.json().get("files", []):
+            files[f["filename"]] = f
+    return [files[k] for k in sorted(files)]
+
 def put_file(path, user="", password="", dest="" , block_size=0):
     base = os.path.basename(path)
     if dest:
@@ -19,32 +96,27 @@ def put_file(path, user="", password="", dest="" , block_size=0):
     if block_size > 0:
         global BLOCK_SIZE
         BLOCK_SIZE = block_size*1024  # Convertir a bytes
-    # calcular cuántos bloques necesitamos
-    sizes = []
-    with open(path, "rb") as f:
-        while True:
-            chunk = f.read(BLOCK_SIZE)
-            if not chunk:
-                break
-            sizes.append(len(chunk))
-    num_blocks = len(sizes)
-    if num_blocks == 0:
+    file_size = os.path.getsize(path)
+    if file_size == 0:
         print("Archivo vacío")
         return
 
-    # pedir asignación de bloques al NameNode
-    resp = requests.post(f"{NAMENODE}/namenode/allocate_blocks", json={
+    # pedir asignación de bloques al NameNode (shard) dueño de la ruta; si no hay
+    # BLOCK_SIZE fijo, el NameNode elige el tamaño según file_size y los datanodes vivos
+    namenode = namenode_for(filename)
+    resp = requests.post(f"{namenode}/namenode/allocate_blocks", json={
         "filename": filename,
-        "num_blocks": num_blocks,
+        "file_size": file_size,
         "user": user,
         "password": password,
-        "block_size": BLOCK_SIZE,
+        "block_size": BLOCK_SIZE or None,
         "dest": dest
     })
     if resp.status_code != 200:
         print("Error al pedir asignación:", resp.text)
         return
     allocation = resp.json()["allocation"]
+    print(f"Tamaño de bloque: {resp.json()['block_size']} bytes ({len(allocation)} bloques)")
 
     # subir cada bloque al DataNode correspondiente
     with open(path, "rb") as f:
@@ -53,7 +125,9 @@ def put_file(path, user="", password="", dest="" , block_size=0):
             block_id = alloc["block_id"]
             datanode_url = alloc["datanode_url"]
 
-            chunk = f.read(BLOCK_SIZE)
+            # cada bloque trae su offset y longitud (pueden ser distintas)
+            f.seek(alloc["offset"])
+            chunk = f.read(alloc["length"])
             files = {"file": (f"{block_id}.bin", chunk)}
 
             print(f"Subiendo bloque {i} a {datanode_url}...")
@@ -81,7 +155,7 @@ def put_file(path, user="", password="", dest="" , block_size=0):
                 "dest": dest
 
             }
-            rc = requests.post(f"{NAMENODE}/namenode/confirm_block", json=confirm)
+            rc = requests.post(f"{namenode}/namenode/confirm_block", json=confirm)
             if rc.status_code != 200:
                 print("Error al confirmar bloque:", rc.text)
                 return
@@ -90,12 +164,43 @@ def put_file(path, user="", password="", dest="" , block_size=0):
 
     print("Subida completa :)")
 
-def get_file(filename, outpath, user="", password=""):
+def download_block(outf, dn, b, start, verify=False):
+    """Descarga un bloque desde `dn` y lo escribe en `start`. True si llegó completo (y verificado)."""
+    print(f"Descargando bloque {b['block_index']} desde {dn}...")
+    outf.seek(start)
+    try:
+        r = requests.get(f"{dn}/datanode/get_block", params={"block_id": b["block_id"]}, stream=True)
+        if r.status_code != 200:
+            print("Error al descargar bloque:", r.text)
+            return False
+        # con verify el hash se calcula mientras se descarga (sin segunda pasada)
+        h = hashlib.sha256() if verify else None
+        received = 0
+        for chunk in r.iter_content(64*1024):
+            outf.write(chunk)
+            received += len(chunk)
+            if h:
+                h.update(chunk)
+    except requests.RequestException as e:
+        print("Error al descargar bloque:", e)
+        return False
+    if received != b["size"]:
+        print(f"Error: bloque {b['block_index']} incompleto ({received} de {b['size']} bytes)")
+        return False
+    if h and h.hexdigest() != b["checksum"]:
+        print(f"Error: checksum inválido en bloque {b['block_index']} ({dn})")
+        return False
+    # un intento fallido anterior pudo escribir de más
+    outf.truncate(start + received)
+    print(f"Bloque {b['block_index']} descargado ({b['size']} bytes)")
+    return True
+
+def get_file(filename, outpath, user="", password="", verify=False):
     # Construir la ruta completa con el usuario para pedirle a NameNode
     if not filename.startswith("/user/"): #Verificamos si no ingresaron la ruta completa
         filename = f"/user/{user}/{filename}"
         
-    r = requests.get(f"{NAMENODE}/namenode/metadata", params={"filename": filename, "user": user, "password": password})
+    r = requests.get(f"{namenode_for(filename)}/namenode/metadata", params={"filename": filename, "user": user, "password": password})
     
     if r.status_code != 200:
         print("Error al obtener metadata:", r.text)
@@ -106,20 +211,24 @@ def get_file(filename, outpath, user="", password=""):
         print(f"El archivo todavía no está disponible (status={meta['status']})")
         return
 
-    # descargar y reconstruir archivo
+    # descargar y reconstruir archivo; cada bloque se escribe en su offset,
+    # sin asumir que todos tienen el mismo tamaño
     with open(outpath, "wb") as outf:
         for b in sorted(meta["blocks"], key=lambda x: x["block_index"]):
-            dn = b["datanode_url"]
-            block_id = b["block_id"]
-
-            print(f"Descargando bloque {b['block_index']} desde {dn}...")
-            r2 = requests.get(f"{dn}/datanode/get_block", params={"block_id": block_id}, stream=True)
-            if r2.status_code != 200:
-                print("Error al descargar bloque:", r2.text)
-                return
-            for chunk in r2.iter_content(64*1024):
-                outf.write(chunk)
-            print(f"Bloque {b['block_index']} descargado ({b['size']} bytes)")
+            start = b["offset"] if b.get("offset") is not None else outf.tell()
+            # si una copia no responde, llega incompleta o no pasa la verificación,
+            # se prueba con la siguiente réplica
+            for dn in [b["datanode_url"]] + b.get("replicas", []):
+                if download_block(outf, dn, b, start, verify):
+                    break
+            else:
+                ok = False
+                break
+        else:
+            ok = True
+    if not ok:
+        os.remove(outpath)  # no dejar un archivo a medio escribir o corrupto
+        return
 
     print(f"Archivo reconstruido en {outpath} :)")
 
@@ -133,7 +242,7 @@ if __name__ == "__main__":
     p_put.add_argument("--user", default="", help="Usuario")
     p_put.add_argument("--dest", default="", help="Directorio destino en el DFS")
     p_put.add_argument("--password", default="", help="Contraseña")
-    p_put.add_argument("--block_size", type=int, default=0, help="Tamaño de bloque en bytes (default: 64kb)")
+    p_put.add_argument("--block_size", type=int, default=0, help="Tamaño de bloque en KB (default: automático, lo sugiere el NameNode)")
 
 
     # comando get
@@ -142,6 +251,7 @@ if __name__ == "__main__":
     p_get.add_argument("outpath", help="Ruta de salida")
     p_get.add_argument("--user", default="", help="Usuario")
     p_get.add_argument("--password", default="", help="Contraseña")
+    p_get.add_argument("--verify", action="store_true", help="Verificar el checksum de cada bloque al descargarlo")
     
     # comando ls
     p_ls = sub.add_parser("ls", help="Listar archivos en un directorio")
@@ -178,35 +288,33 @@ if __name__ == "__main__":
     if args.cmd == "put":
         put_file(args.path, args.user, args.password, args.dest, args.block_size)
     elif args.cmd == "get":
-        get_file(args.filename, args.outpath, args.user, args.password)
+        get_file(args.filename, args.outpath, args.user, args.password, args.verify)
     elif args.cmd == "ls":
-        r = requests.get(f"{NAMENODE}/namenode/ls", params={"path": args.path, "user": args.user, "password": args.password})
-        if r.status_code == 200:
-            data = r.json()
-            if not data.get("files"):
-                print(f"(vacío) No hay archivos en {args.path}")
-            for f in data.get("files", []):
-                print(f"{f['filename']} - {f['size']} bytes - {f['status']}")
-        else:
-            print("Error:", r.text)
+        files = list_path(args.path, args.user, args.password)
+        if not files:
+            print(f"(vacío) No hay archivos en {args.path}")
+        for f in files:
+            print(f"{f['filename']} - {f['size']} bytes - {f['status']}")
 
     elif args.cmd == "rm":
         fname = args.filename
         if not fname.startswith("/user/"):
             fname = f"/user/{args.user}/{fname}"
-        r = requests.delete(f"{NAMENODE}/namenode/delete_file", params={"filename": fname, "user": args.user, "password": args.password})
+        r = requests.delete(f"{namenode_for(fname)}/namenode/delete_file", params={"filename": fname, "user": args.user, "password": args.password})
         print(r.json() if r.status_code == 200 else f"Error: {r.text}")
     elif args.cmd == "mkdir":
-        r = requests.post(f"{NAMENODE}/namenode/mkdir", json={"path": args.path, "user": args.user, "password": args.password})
+        r = requests.post(f"{namenode_for(args.path)}/namenode/mkdir", json={"path": args.path, "user": args.user, "password": args.password})
         print(r.json() if r.status_code == 200 else f"Error: {r.text}")
 
     elif args.cmd == "rmdir":
-        r = requests.post(f"{NAMENODE}/namenode/rmdir", json={"path": args.path, "user": args.user, "password": args.password})
+        r = requests.post(f"{namenode_for(args.path)}/namenode/rmdir", json={"path": args.path, "user": args.user, "password": args.password})
         print(r.json() if r.status_code == 200 else f"Error: {r.text}")
 
     elif args.cmd == "register":
-        r = requests.post(f"{NAMENODE}/namenode/register", json={"username": args.username, "password": args.password})
-        print(r.json() if r.status_code == 200 else f"Error: {r.text}")
+        # cada shard tiene su propia tabla de usuarios: se registra en todos
+        for nn in all_namenodes():
+            r = requests.post(f"{nn}/namenode/register", json={"username": args.username, "password": args.password})
+            print(r.json() if r.status_code == 200 else f"Error ({nn}): {r.text}")
 
     else:
         parser.print_help()
@@ -1,6 +1,7 @@
 # datanode/app.py
 import os
 import hashlib
+import sqlite3
 from fastapi import FastAPI, UploadFile, File, HTTPException
 from fastapi.responses import StreamingResponse
 import aiofiles
@@ -12,10 +13,19 @@ import threading, time
 
 DATA_DIR = os.environ.get("DATA_DIR", "/data/blocks")
 NAMENODE = os.environ.get("NAMENODE_URL", "http://namenode:8000")
+# Con el namespace repartido en varios NameNodes, NAMENODE_URL puede ser una lista
+# separada por comas: el DataNode se registra y manda heartbeats a todos.
+NAMENODES = [u.strip() for u in NAMENODE.split(",") if u.strip()]
 HOSTNAME = os.environ.get("HOSTNAME") or "datanode"
 SELF_URL = os.environ.get("DATANODE_URL", f"http://{HOSTNAME}:8001") # Estas dos lineas se hacen para que cada contenedor "datanode" tenga su
                                                                      #  propia URL y no se sobreescriban las URLs de los contenedores                                         
 
+# Scrubber: re-hashea los bloques en segundo plano limitado a SCRUB_MBPS MB/s.
+# Checksums y progreso se guardan en DN_DB (dentro de DATA_DIR para que persista en el volumen).
+DN_DB = os.environ.get("DN_DB", os.path.join(DATA_DIR, ".datanode.db"))
+SCRUB_MBPS = float(os.environ.get("SCRUB_MBPS", 1))                 # 0 desactiva el scrubber
+SCRUB_INTERVAL_SECS = int(os.environ.get("SCRUB_INTERVAL_SECS", 3600))  # pausa entre pasadas completas
+
 os.makedirs(DATA_DIR, exist_ok=True)
 
 app = FastAPI(title="DataNode - GridDFS")
@@ -24,29 +34,192 @@ class RegInfo(BaseModel):
     datanode_url: str
     capacity: int = -1
     free: int = -1
-def heartbeat_loop():
+
+class CopyReq(BaseModel):
+    block_id: str
+    source_url: str
+    mbps: float = 0
+
+# --- DB local (checksums y progreso del scrubber) -----------------------
+def db_conn():
+    return sqlite3.connect(DN_DB, check_same_thread=False)
+
+def init_db():
+    conn = db_conn()
+    c = conn.cursor()
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS blocks (
+        safe_name TEXT PRIMARY KEY,
+        block_id TEXT,
+        size INTEGER,
+        checksum TEXT,
+        last_verified TEXT,
+        corrupt_reported TEXT
+    )""")
+    # bases creadas antes de corrupt_reported
+    cols = [r[1] for r in c.execute("PRAGMA table_info(blocks)").fetchall()]
+    if "corrupt_reported" not in cols:
+        c.execute("ALTER TABLE blocks ADD COLUMN corrupt_reported TEXT")
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS scrub_state (
+        id INTEGER PRIMARY KEY CHECK (id = 1),
+        cursor TEXT
+    )""")
+    c.execute("INSERT OR IGNORE INTO scrub_state(id, cursor) VALUES (1, '')")
+    conn.commit()
+    conn.close()
+
+init_db()
+
+def block_files():
+    """Nombres de los bloques en DATA_DIR (ignora la DB y los .tmp de escrituras en curso)."""
+    return sorted(n for n in os.listdir(DATA_DIR)
+                  if not n.startswith(".") and not n.endswith(".tmp")
+                  and os.path.isfile(os.path.join(DATA_DIR, n)))
+
+def record_block(safe_name, block_id, size, checksum):
+    conn = db_conn()
+    conn.execute("INSERT OR REPLACE INTO blocks(safe_name, block_id, size, checksum, last_verified) VALUES (?, ?, ?, ?, ?)",
+                 (safe_name, block_id, size, checksum, None))
+    conn.commit()
+    conn.close()
+
+def throttle(start, done_bytes, mbps):
+    """Duerme lo necesario para que done_bytes desde start no supere mbps MB/s (0 = sin límite)."""
+    if mbps > 0:
+        ahead = done_bytes / (mbps * 1024 * 1024) - (time.monotonic() - start)
+        if ahead > 0:
+            time.sleep(ahead)
+
+def hash_block(path, mbps=0):
+    """sha256 de un bloque leyendo por chunks; si mbps > 0 duerme para no superar ese ritmo."""
+    h = hashlib.sha256()
+    start = time.monotonic()
+    read = 0
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(64*1024)
+            if not chunk:
+                break
+            h.update(chunk)
+            read += len(chunk)
+            throttle(start, read, mbps)
+    return h.hexdigest()
+
+def report_corrupt(block_id, expected, actual):
+    """True si algún NameNode aceptó el reporte (solo el shard dueño del archivo responde 200)."""
+    reported = False
+    for nn in NAMENODES:
+        try:
+            r = requests.post(f"{nn}/namenode/report_corrupt_block", json={
+                "datanode_url": SELF_URL,
+                "block_id": block_id,
+                "expected": expected,
+                "actual": actual
+            }, timeout=3)
+        except Exception as e:
+            print("Error reportando bloque corrupto:", e)
+            continue
+        reported = reported or r.status_code == 200
+    return reported
+
+def fetch_expected_checksum(block_id):
+    """
+    Pide al NameNode (a cada shard) el checksum registrado de un bloque.
+    Devuelve (block_id real, checksum) o (block_id, None) si nadie lo conoce.
+    """
+    for nn in NAMENODES:
+        try:
+            r = requests.get(f"{nn}/namenode/block_checksum",
+                             params={"block_id": block_id, "datanode_url": SELF_URL}, timeout=3)
+        except Exception as e:
+            print("Error consultando checksum:", e)
+            continue
+        if r.status_code == 200:
+            info = r.json()
+            return info["block_id"], info["checksum"]
+    return block_id, None
+
+def scrub_pass():
+    """
+    Una pasada del scrubber. Avanza en orden de nombre desde el cursor guardado,
+    de modo que si el DataNode se reinicia continúa donde iba.
+    """
+    conn = db_conn()
+    cursor = conn.execute("SELECT cursor FROM scrub_state WHERE id=1").fetchone()[0] or ""
+    for name in block_files():
+        if name <= cursor:
+            continue
+        path = os.path.join(DATA_DIR, name)
+        try:
+            actual = hash_block(path, SCRUB_MBPS)
+        except FileNotFoundError:
+            continue  # borrado mientras lo revisábamos
+        now = time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime())
+        row = conn.execute("SELECT block_id, checksum, corrupt_reported FROM blocks WHERE safe_name=?",
+                           (name,)).fetchone()
+        if row is None or row[1] is None:
+            # bloque sin checksum local (anterior al scrubber): la referencia la da el NameNode
+            block_id, expected = fetch_expected_checksum(row[0] if row else name)
+            conn.execute("INSERT OR REPLACE INTO blocks(safe_name, block_id, size, checksum, last_verified) VALUES (?, ?, ?, ?, ?)",
+                         (name, block_id, os.path.getsize(path), expected, None))
+            conn.commit()  # no dejar la transacción abierta durante las llamadas de red
+            row = (block_id, expected, None)
+        if row[1] is None:
+            pass  # sin referencia todavía: queda sin verificar y se reintenta en la próxima pasada
+        elif row[1] != actual:
+            # se reporta una sola vez (si algún NameNode lo aceptó; si no, se reintenta
+            # en la próxima pasada); record_block limpia la marca si el bloque se reescribe
+            if not row[2]:
+                print(f"Bloque corrupto {name}: esperado {row[1]}, obtenido {actual}")
+                if report_corrupt(row[0], row[1], actual):
+                    conn.execute("UPDATE blocks SET corrupt_reported=? WHERE safe_name=?", (now, name))
+        else:
+            conn.execute("UPDATE blocks SET last_verified=?, corrupt_reported=NULL WHERE safe_name=?", (now, name))
+        conn.execute("UPDATE scrub_state SET cursor=? WHERE id=1", (name,))
+        conn.commit()
+    # pasada completa: la siguiente empieza desde el principio
+    conn.execute("UPDATE scrub_state SET cursor='' WHERE id=1")
+    conn.commit()
+    conn.close()
+
+def scrub_loop():
     while True:
         try:
-            info = {"datanode_url": SELF_URL, "capacity": -1, "free": -1}
-            requests.post(f"{NAMENODE}/namenode/heartbeat", json=info, timeout=3)
-            print(f"Heartbeat enviado a {NAMENODE}")
+            scrub_pass()
         except Exception as e:
-            print("Error enviando heartbeat:", e)
+            print("Error en scrubber:", e)
+        time.sleep(SCRUB_INTERVAL_SECS)
+
+def heartbeat_loop():
+    while True:
+        info = {"datanode_url": SELF_URL, "capacity": -1, "free": -1}
+        for nn in NAMENODES:
+            try:
+                requests.post(f"{nn}/namenode/heartbeat", json=info, timeout=3)
+                print(f"Heartbeat enviado a {nn}")
+            except Exception as e:
+                print("Error enviando heartbeat:", e)
         time.sleep(10)  # cada 10 segundos
 
 @app.on_event("startup")
 def register_to_namenode():
-    try:
-        info = {"datanode_url": SELF_URL, "capacity": -1, "free": -1}
-        requests.post(f"{NAMENODE}/namenode/register_datanode", json=info, timeout=3)
-        print("Registered to NameNode:", NAMENODE)
-    except Exception as e:
-        print("Could not register to NameNode:", e)
+    info = {"datanode_url": SELF_URL, "capacity": -1, "free": -1}
+    for nn in NAMENODES:
+        try:
+            requests.post(f"{nn}/namenode/register_datanode", json=info, timeout=3)
+            print("Registered to NameNode:", nn)
+        except Exception as e:
+            print("Could not register to NameNode:", e)
 
     # lanzar hilo de heartbeat
     t = threading.Thread(target=heartbeat_loop, daemon=True)
     t.start()
 
+    # lanzar hilo del scrubber
+    if SCRUB_MBPS > 0:
+        threading.Thread(target=scrub_loop, daemon=True).start()
+
 
 @app.post("/datanode/store_block")
 async def store_block(block_id: str, file: UploadFile = File(...)):
@@ -59,6 +232,7 @@ async def store_block(block_id: str, file: UploadFile = File(...)):
         await f.write(content)
     os.replace(tmp, path)
     checksum = hashlib.sha256(content).hexdigest()
+    record_block(safe_name, block_id, len(content), checksum)
     return {"status":"ok", "block_id": safe_name, "size": len(content), "checksum": checksum}
 
 @app.get("/datanode/get_block")
@@ -76,13 +250,43 @@ def get_block(block_id: str):
                 yield chunk
     return StreamingResponse(iterfile(), media_type="application/octet-stream")
 
+@app.post("/datanode/copy_from_peer")
+def copy_from_peer(req: CopyReq):
+    """
+    Copia un bloque desde otro DataNode (lo pide el NameNode para re-replicar o rebalancear).
+    Se descarga en streaming limitado a req.mbps MB/s y se escribe de forma atómica.
+    """
+    safe_name = req.block_id.replace("/", "_")
+    path = os.path.join(DATA_DIR, safe_name)
+    try:
+        r = requests.get(f"{req.source_url}/datanode/get_block", params={"block_id": req.block_id},
+                         stream=True, timeout=10)
+    except Exception as e:
+        raise HTTPException(status_code=502, detail=f"source unreachable: {e}")
+    if r.status_code != 200:
+        raise HTTPException(status_code=502, detail=f"source returned {r.status_code}")
+
+    h = hashlib.sha256()
+    size = 0
+    start = time.monotonic()
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        for chunk in r.iter_content(64*1024):
+            f.write(chunk)
+            h.update(chunk)
+            size += len(chunk)
+            throttle(start, size, req.mbps)
+    os.replace(tmp, path)
+    checksum = h.hexdigest()
+    record_block(safe_name, req.block_id, size, checksum)
+    return {"status": "ok", "block_id": safe_name, "size": size, "checksum": checksum}
+
 @app.get("/datanode/list_blocks")
 def list_blocks():
     items = []
-    for name in os.listdir(DATA_DIR):
+    for name in block_files():
         p = os.path.join(DATA_DIR, name)
-        if os.path.isfile(p):
-            items.append({"block_id": name, "size": os.path.getsize(p)})
+        items.append({"block_id": name, "size": os.path.getsize(p)})
     return {"blocks": items}
 
 
@@ -92,6 +296,10 @@ def delete_block(block_id: str):
     path = os.path.join(DATA_DIR, safe_name)
     if os.path.exists(path):
         os.remove(path)
+        conn = db_conn()
+        conn.execute("DELETE FROM blocks WHERE safe_name=?", (safe_name,))
+        conn.commit()
+        conn.close()
         return {"status": "ok", "deleted": block_id}
     else:
         raise HTTPException(status_code=404, detail="block not found")
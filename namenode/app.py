@@ -5,13 +5,41 @@ import uuid
 from fastapi import FastAPI, HTTPException
 from pydantic import BaseModel
 import requests
-import os, json
-from datetime import datetime, timedelta
+import os, json, math, time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from typing import List, Optional
 from passlib.context import CryptContext
 
 
 
 DB_PATH = os.environ.get("NN_DB", "metadata.db")
+# Política de tamaño de bloque automático (cuando el cliente no fija block_size)
+MIN_BLOCK_SIZE = int(os.environ.get("NN_MIN_BLOCK_SIZE", 64*1024))          # 64 KB
+MAX_BLOCK_SIZE = int(os.environ.get("NN_MAX_BLOCK_SIZE", 128*1024*1024))    # 128 MB
+BLOCK_ALIGN = int(os.environ.get("NN_BLOCK_ALIGN", 4*1024))                 # múltiplo de 4 KB
+TARGET_PARALLELISM = int(os.environ.get("NN_TARGET_PARALLELISM", 2))        # bloques por datanode vivo
+# Liveness de datanodes: se mantiene en memoria y se persiste en lote cada LIVENESS_FLUSH_SECS
+LIVENESS_FLUSH_SECS = int(os.environ.get("NN_LIVENESS_FLUSH_SECS", 30))
+# Re-replicación y rebalanceo en segundo plano
+REPLICATION = int(os.environ.get("NN_REPLICATION", 1))                          # copias deseadas por bloque
+REPLICATION_INTERVAL_SECS = int(os.environ.get("NN_REPLICATION_INTERVAL_SECS", 30))
+REPLICATION_MBPS = float(os.environ.get("NN_REPLICATION_MBPS", 10))             # límite por copia (0 = sin límite)
+REPLICATION_MAX_CONCURRENT = int(os.environ.get("NN_REPLICATION_MAX_CONCURRENT", 4))  # copias simultáneas en el clúster
+# Con el namespace repartido, cada shard re-replica y rebalancea sus propios bloques sobre
+# los mismos DataNodes: las copias simultáneas se reparten en enteros entre los shards
+# (NN_SHARD_INDEX = 0..NN_SHARD_COUNT-1) para que entre todos no pasen del límite.
+SHARD_COUNT = max(1, int(os.environ.get("NN_SHARD_COUNT", 1)))
+SHARD_INDEX = int(os.environ.get("NN_SHARD_INDEX", 0))
+REPLICATION_SLOTS = (REPLICATION_MAX_CONCURRENT // SHARD_COUNT
+                     + (1 if SHARD_INDEX < REPLICATION_MAX_CONCURRENT % SHARD_COUNT else 0))
+BALANCE_THRESHOLD = float(os.environ.get("NN_BALANCE_THRESHOLD", 0.1))          # desvío tolerado sobre el promedio
+DEAD_TIMEOUT = 60                                                               # segundos sin heartbeat para considerar caído un datanode
+# Namespace en memoria + edit log (WAL) + checkpoint periódico en META_DIR
+META_DIR = os.environ.get("NN_META_DIR", os.path.dirname(os.path.abspath(DB_PATH)))
+CHECKPOINT_SECS = int(os.environ.get("NN_CHECKPOINT_SECS", 300))
+CHECKPOINT_EDITS = int(os.environ.get("NN_CHECKPOINT_EDITS", 10000))           # checkpoint anticipado tras N edits
 lock = threading.Lock()
 app = FastAPI(title="NameNode - GridDFS (SQLite single-table + datanode registry)")
 
@@ -20,9 +48,11 @@ pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 
 # --- DB helpers --------------------------------------------------------
 def init_db():
+    # cada shard puede correr como proceso local con su propio NN_DB
+    os.makedirs(os.path.dirname(os.path.abspath(DB_PATH)), exist_ok=True)
     conn = sqlite3.connect(DB_PATH)
     c = conn.cursor()
-    # tabla de archivos (metadatos)
+    # tabla de archivos (metadatos); desde el edit log solo se lee para migrar bases antiguas
     c.execute("""
     CREATE TABLE IF NOT EXISTS files (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -86,23 +116,347 @@ def auth_user(username, password):
         return True
     return False
 
-def get_active_datanodes(conn, timeout=30):
-    now = datetime.utcnow()
-    c = conn.cursor()
-    rows = c.execute("SELECT url, last_seen FROM datanodes").fetchall()
+# --- Liveness de datanodes (en memoria) --------------------------------
+# url -> último heartbeat (epoch). El OrderedDict se mantiene ordenado del más
+# antiguo al más reciente, así que las consultas recorren solo los nodos vivos.
+# Los heartbeats NO toman el lock global; live_lock solo protege el dict.
+liveness = OrderedDict()
+liveness_dirty = set()
+live_lock = threading.Lock()
+# la tabla datanodes tiene su propio lock: escribirla no frena las mutaciones del namespace
+dn_lock = threading.Lock()
+
+def touch_datanode(url, ts=None, register=False):
+    """Marca un datanode como visto. Solo acepta nodos conocidos salvo register=True."""
+    ts = ts or time.time()
+    with live_lock:
+        if url not in liveness and not register:
+            return False
+        liveness[url] = ts
+        liveness.move_to_end(url)
+        liveness_dirty.add(url)
+    return True
+
+def get_active_datanodes(timeout=30):
+    """Datanodes con heartbeat en los últimos `timeout` segundos (del más reciente al más antiguo)."""
+    cutoff = time.time() - timeout
     active = []
-    for url, last_seen in rows:
-        if last_seen:
-            last_seen_dt = datetime.fromisoformat(last_seen)
-            if now - last_seen_dt < timedelta(seconds=timeout):
-                active.append(url)
+    with live_lock:
+        for url in reversed(liveness):
+            if liveness[url] < cutoff:
+                break
+            active.append(url)
     return active
 
+def load_liveness():
+    """Carga last_seen persistido en la tabla en memoria (al arrancar)."""
+    conn = db_conn()
+    rows = conn.execute("SELECT url, last_seen FROM datanodes").fetchall()
+    conn.close()
+    loaded = []
+    for url, last_seen in rows:
+        # last_seen se guarda en UTC sin zona horaria
+        ts = datetime.fromisoformat(last_seen).replace(tzinfo=timezone.utc).timestamp() if last_seen else 0
+        loaded.append((ts, url))
+    with live_lock:
+        liveness.clear()
+        for ts, url in sorted(loaded):
+            liveness[url] = ts
+        liveness_dirty.clear()
+
+def flush_liveness():
+    """Persiste en una sola transacción los last_seen que cambiaron desde el último flush."""
+    with live_lock:
+        seen = {u: liveness[u] for u in liveness_dirty}
+    if not seen:
+        return
+    with dn_lock:
+        conn = db_conn()
+        conn.executemany("UPDATE datanodes SET last_seen=? WHERE url=?",
+                         [(datetime.utcfromtimestamp(ts).isoformat(), u) for u, ts in seen.items()])
+        conn.commit()
+        conn.close()
+    # solo después del commit; si llegó un heartbeat nuevo mientras tanto, queda pendiente
+    with live_lock:
+        for u, ts in seen.items():
+            if liveness.get(u) == ts:
+                liveness_dirty.discard(u)
+
+def liveness_flush_loop():
+    while True:
+        time.sleep(LIVENESS_FLUSH_SECS)
+        try:
+            flush_liveness()
+        except Exception as e:
+            print("Error persistiendo liveness:", e)
+
+# --- Namespace en memoria, edit log y checkpoint ----------------------
+# El namespace (archivos y directorios) vive en `namespace`: filename -> registro.
+# Cada mutación, con `lock` tomado, encola en el edit log una operación delta
+# (mkdir, add_blocks, confirm, locations, corrupt, del) y apply_edit la aplica
+# reemplazando el registro y los bloques que cambian (copy-on-write: nada se
+# modifica en sitio, así los lectores sin lock y el checkpoint ven registros
+# consistentes). Los registros completos solo se escriben en el snapshot.
+# Después, ya sin el lock, cada mutación espera a que su txid sea durable: el
+# primer hilo que llega escribe y hace fsync de todo lo pendiente (group commit)
+# y los demás solo esperan, así muchas mutaciones comparten un fsync.
+# Periódicamente se escribe un snapshot (fsimage.json) y se descartan los
+# segmentos edits_<txid>.log que ya quedaron cubiertos por él.
+namespace = {}
+# índice block_id (y su nombre con "/" reemplazados, como lo guarda el DataNode) -> filename
+block_owner = {}
+edit_cond = threading.Condition()
+# serializa checkpoints completos (el loop periódico y el del shutdown comparten fsimage.json.tmp)
+checkpoint_lock = threading.Lock()
+edit_pending = []
+edit_last_txid = 0
+edit_synced_txid = 0
+edit_syncing = False
+edit_file = None
+edits_since_checkpoint = 0
+
+def fsimage_path():
+    return os.path.join(META_DIR, "fsimage.json")
+
+def edit_segment_path(start_txid):
+    return os.path.join(META_DIR, f"edits_{start_txid:012d}.log")
+
+def edit_segments():
+    """Segmentos del edit log ordenados por txid inicial: [(start_txid, path)]."""
+    segs = []
+    for name in os.listdir(META_DIR):
+        if name.startswith("edits_") and name.endswith(".log"):
+            segs.append((int(name[len("edits_"):-len(".log")]), os.path.join(META_DIR, name)))
+    return sorted(segs)
+
+def index_blocks(filename, blocks, add=True):
+    for b in blocks:
+        for key in (b["block_id"], b["block_id"].replace("/", "_")):
+            if add:
+                block_owner[key] = filename
+            elif block_owner.get(key) == filename:
+                del block_owner[key]
+
+def replace_record(filename, rec):
+    """Reemplaza (o borra, con rec=None) un registro manteniendo block_owner al día."""
+    old = namespace.get(filename)
+    if old:
+        index_blocks(filename, old["blocks"], add=False)
+    if rec is None:
+        namespace.pop(filename, None)
+    else:
+        namespace[filename] = rec
+        index_blocks(filename, rec["blocks"])
+
+def block_locations(b):
+    return [b["datanode_url"]] + b.get("replicas", [])
+
+def set_block_locations(b, locations):
+    b["datanode_url"] = locations[0]
+    b["replicas"] = locations[1:]
+
+def apply_edit(entry):
+    op = entry["op"]
+    if op == "set":
+        # registro completo (edit logs escritos antes de las operaciones delta)
+        replace_record(entry["file"]["filename"], entry["file"])
+        return
+    filename = entry["filename"]
+    if op == "del":
+        replace_record(filename, None)
+    elif op == "mkdir":
+        replace_record(filename, {"filename": filename, "owner": entry["owner"], "size": 0, "block_size": 0,
+                                  "status": "dir", "created_at": entry["created_at"], "blocks": []})
+    elif op == "add_blocks":
+        rec = dict(namespace.get(filename) or {
+            "filename": filename, "owner": entry["owner"], "size": None,
+            "status": "incomplete", "created_at": entry["created_at"]
+        })
+        rec["blocks"] = entry["blocks"]
+        rec["block_size"] = entry["block_size"]
+        replace_record(filename, rec)
+    else:
+        # operaciones sobre un bloque existente
+        rec = dict(namespace[filename])
+        blocks = list(rec["blocks"])
+        if op == "confirm":
+            i = next(i for i, b in enumerate(blocks) if b["block_index"] == entry["block_index"])
+        else:
+            i = next(i for i, b in enumerate(blocks) if b["block_id"] == entry["block_id"])
+        b = blocks[i] = dict(blocks[i])
+        if op == "confirm":
+            b.update(size=entry["size"], checksum=entry["checksum"], present=True)
+            all_present = all(x["present"] for x in blocks)
+            # offsets reales (para archivos asignados sin longitudes conocidas)
+            if all_present:
+                offset = 0
+                for j in sorted(range(len(blocks)), key=lambda j: blocks[j]["block_index"]):
+                    if blocks[j].get("offset") != offset:
+                        blocks[j] = dict(blocks[j], offset=offset)
+                    offset += blocks[j]["size"]
+            rec["size"] = sum(x["size"] for x in blocks)
+            rec["status"] = "available" if all_present else "incomplete"
+        elif op == "locations":
+            set_block_locations(b, entry["locations"])
+        elif op == "corrupt":
+            b["corrupt"] = True
+            rec["status"] = "corrupt"
+        rec["blocks"] = blocks
+        namespace[filename] = rec
+
+def log_edit(entry):
+    """Aplica una edición en memoria y la encola en el edit log. Llamar con `lock` tomado."""
+    global edit_last_txid, edits_since_checkpoint
+    apply_edit(entry)
+    with edit_cond:
+        edit_last_txid += 1
+        entry = dict(entry, txid=edit_last_txid)
+        edit_pending.append(json.dumps(entry, separators=(",", ":")) + "\n")
+        edits_since_checkpoint += 1
+        return edit_last_txid
+
+def drop_file_record(filename):
+    return log_edit({"op": "del", "filename": filename})
+
+def set_locations(filename, block_id, locations):
+    return log_edit({"op": "locations", "filename": filename, "block_id": block_id, "locations": locations})
+
+def sync_edits(txid):
+    """Bloquea hasta que `txid` esté en disco. Llamar SIN `lock` para que el fsync se comparta."""
+    global edit_synced_txid, edit_syncing
+    with edit_cond:
+        while edit_synced_txid < txid:
+            if edit_syncing:
+                edit_cond.wait()
+                continue
+            edit_syncing = True
+            batch, upto = edit_pending[:], edit_last_txid
+            del edit_pending[:]
+            edit_cond.release()
+            try:
+                edit_file.write("".join(batch))
+                edit_file.flush()
+                os.fsync(edit_file.fileno())
+            except Exception:
+                edit_cond.acquire()
+                edit_pending[:0] = batch  # se reintenta en el próximo sync
+                edit_syncing = False
+                edit_cond.notify_all()
+                raise
+            edit_cond.acquire()
+            edit_syncing = False
+            edit_synced_txid = upto
+            edit_cond.notify_all()
+
+def checkpoint():
+    """Escribe un snapshot del namespace y descarta los segmentos del edit log que cubre."""
+    global edit_file, edits_since_checkpoint
+    with checkpoint_lock:
+        with lock:
+            sync_edits(edit_last_txid)
+            txid = edit_last_txid
+            # copia superficial: los registros son copy-on-write, se serializan fuera del lock
+            snap = dict(namespace)
+            # los nuevos edits van a un segmento nuevo
+            with edit_cond:
+                edit_file.close()
+                edit_file = open(edit_segment_path(txid + 1), "a")
+                edits_since_checkpoint = 0
+        image = json.dumps({"txid": txid, "files": snap}, separators=(",", ":"))
+        tmp = fsimage_path() + ".tmp"
+        with open(tmp, "w") as f:
+            f.write(image)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, fsimage_path())
+        for start, path in edit_segments():
+            if start <= txid:
+                os.remove(path)
+
+def load_namespace():
+    """
+    Arranque: carga el último snapshot y re-aplica los edits posteriores.
+    Si no hay snapshot ni edits (primera vez), importa la tabla files de SQLite.
+    """
+    global edit_last_txid, edit_synced_txid, edit_file
+    os.makedirs(META_DIR, exist_ok=True)
+    namespace.clear()
+    block_owner.clear()
+    txid = 0
+    if os.path.exists(fsimage_path()):
+        with open(fsimage_path()) as f:
+            image = json.load(f)
+        for filename, rec in image["files"].items():
+            replace_record(filename, rec)
+        txid = image["txid"]
+
+    segments = edit_segments()
+    for _, path in segments:
+        with open(path, "r+b") as f:
+            while True:
+                pos = f.tell()
+                line = f.readline()
+                if not line:
+                    break
+                try:
+                    if not line.endswith(b"\n"):
+                        raise ValueError("incomplete line")
+                    entry = json.loads(line)
+                except ValueError:
+                    # última línea a medio escribir (caída durante un append): se descarta
+                    f.truncate(pos)
+                    break
+                if entry["txid"] > txid:
+                    apply_edit(entry)
+                    txid = entry["txid"]
+
+    migrate = not segments and not os.path.exists(fsimage_path())
+    if migrate:
+        conn = db_conn()
+        rows = conn.execute("SELECT filename, owner, size, block_size, status, created_at, blocks_json FROM files").fetchall()
+        conn.close()
+        for filename, owner, size, block_size, status, created_at, blocks_json in rows:
+            replace_record(filename, {"filename": filename, "owner": owner, "size": size, "block_size": block_size,
+                                      "status": status, "created_at": created_at, "blocks": json.loads(blocks_json)})
+
+    edit_last_txid = edit_synced_txid = txid
+    edit_file = open(edit_segment_path(txid + 1), "a")
+    if migrate:
+        checkpoint()
+
+def checkpoint_loop():
+    last = time.monotonic()
+    while True:
+        time.sleep(1)
+        if time.monotonic() - last >= CHECKPOINT_SECS or edits_since_checkpoint >= CHECKPOINT_EDITS:
+            try:
+                checkpoint()
+            except Exception as e:
+                print("Error en checkpoint:", e)
+            last = time.monotonic()
+
 def db_conn():
     # cada llamada obtiene una conexión con check_same_thread=False para uso multi-hilo
     return sqlite3.connect(DB_PATH, check_same_thread=False)
 
 init_db()
+load_liveness()
+load_namespace()
+
+@app.on_event("startup")
+def start_liveness_flush():
+    t = threading.Thread(target=liveness_flush_loop, daemon=True)
+    t.start()
+
+@app.on_event("startup")
+def start_checkpoint():
+    t = threading.Thread(target=checkpoint_loop, daemon=True)
+    t.start()
+
+@app.on_event("shutdown")
+def on_shutdown():
+    flush_liveness()
+    checkpoint()
 
 # --- Pydantic models ---------------------------------------------------
 
@@ -111,8 +465,10 @@ class BaseAuth(BaseModel):
     password: str
 class AllocateReq(BaseAuth):
     filename: str
-    num_blocks: int
-    block_size: int = None
+    num_blocks: Optional[int] = None
+    block_size: Optional[int] = None
+    file_size: Optional[int] = None
+    block_sizes: Optional[List[int]] = None
 
 class ConfirmBlockReq(BaseAuth):
     filename: str
@@ -122,6 +478,12 @@ class ConfirmBlockReq(BaseAuth):
     size: int
     checksum: str
 
+class CorruptBlockReq(BaseModel):
+    datanode_url: str
+    block_id: str
+    expected: str = ""
+    actual: str = ""
+
 class RegInfo(BaseModel):
     datanode_url: str
     capacity: int = -1
@@ -137,6 +499,48 @@ class UserReq(BaseModel):
     username: str
     password: str
 # --- Helper -----------------------------------------------------------
+def suggest_block_size(file_size, num_datanodes, parallelism=None):
+    """
+    Sugiere un tamaño de bloque para un archivo de `file_size` bytes.
+    Busca que el archivo quede repartido en ~num_datanodes*parallelism bloques,
+    redondeando a BLOCK_ALIGN y acotando entre MIN_BLOCK_SIZE y MAX_BLOCK_SIZE.
+    """
+    parallelism = parallelism or TARGET_PARALLELISM
+    target_blocks = max(1, num_datanodes) * max(1, parallelism)
+    size = math.ceil(file_size / target_blocks) if file_size > 0 else MIN_BLOCK_SIZE
+    size = math.ceil(size / BLOCK_ALIGN) * BLOCK_ALIGN
+    return max(MIN_BLOCK_SIZE, min(MAX_BLOCK_SIZE, size))
+
+def plan_blocks(req: AllocateReq, num_datanodes):
+    """
+    Calcula (block_size, lista de longitudes) para una solicitud de asignación.
+    - block_sizes explícito: se respeta tal cual (bloques de longitud variable).
+    - file_size conocido: se divide en bloques de block_size (o el sugerido), el último más corto.
+    - solo num_blocks: comportamiento anterior, longitudes desconocidas (None).
+    """
+    # valores enviados explícitamente deben ser positivos
+    for field in ("block_size", "num_blocks", "file_size"):
+        value = getattr(req, field)
+        if value is not None and value <= 0:
+            raise HTTPException(status_code=400, detail=f"{field} must be positive")
+
+    if req.block_sizes:
+        if any(n <= 0 for n in req.block_sizes):
+            raise HTTPException(status_code=400, detail="block_sizes must be positive")
+        if req.file_size is not None and sum(req.block_sizes) != req.file_size:
+            raise HTTPException(status_code=400, detail="block_sizes do not add up to file_size")
+        return max(req.block_sizes), list(req.block_sizes)
+
+    if req.file_size is not None:
+        block_size = req.block_size or suggest_block_size(req.file_size, num_datanodes)
+        full, last = divmod(req.file_size, block_size)
+        lengths = [block_size] * full + ([last] if last else [])
+        return block_size, lengths
+
+    if not req.num_blocks:
+        raise HTTPException(status_code=400, detail="num_blocks or file_size required")
+    return req.block_size or 0, [None] * req.num_blocks
+
 def get_registered_datanodes(conn=None):
     """Retorna lista de URLs de datanodes registrados (en orden arbitario)."""
     close_conn = False
@@ -147,21 +551,209 @@ def get_registered_datanodes(conn=None):
     rows = c.execute("SELECT url, capacity, free, last_seen FROM datanodes").fetchall()
     if close_conn:
         conn.close()
-    return [{"url": r[0], "capacity": r[1], "free": r[2], "last_seen": r[3]} for r in rows]
+    # last_seen en memoria es más reciente que el persistido
+    with live_lock:
+        seen = {u: datetime.utcfromtimestamp(ts).isoformat() for u, ts in liveness.items()}
+    return [{"url": r[0], "capacity": r[1], "free": r[2], "last_seen": seen.get(r[0], r[3])} for r in rows]
+
+# --- Re-replicación y rebalanceo ---------------------------------------
+# Cada bloque vive en datanode_url (copia principal) y opcionalmente en "replicas".
+# Un hilo del NameNode revisa periódicamente los metadatos y, sin intervención
+# del cliente, ordena copias DataNode -> DataNode (/datanode/copy_from_peer):
+#  - "replicate": bloques con menos de REPLICATION copias vivas.
+#  - "move": bloques de nodos con más bytes que el promedio hacia los más vacíos.
+copy_pool = ThreadPoolExecutor(max_workers=max(1, REPLICATION_SLOTS))
+in_flight = set()
+in_flight_lock = threading.Lock()
+
+def find_block(block_id, datanode_url):
+    """
+    Busca un bloque por block_id (o su nombre con "/" reemplazados, como lo guarda el DataNode)
+    que tenga una copia en `datanode_url`. Devuelve (filename, bloque) o (None, None).
+    """
+    # en otros shards (o si el archivo ya no existe) el bloque no está en el índice
+    fname = block_owner.get(block_id)
+    rec = namespace.get(fname) if fname else None
+    for b in rec["blocks"] if rec else []:
+        if block_id in (b["block_id"], b["block_id"].replace("/", "_")) \
+                and datanode_url in block_locations(b):
+            return fname, b
+    return None, None
+
+def delete_remote_block(dn, block_id):
+    try:
+        requests.delete(f"{dn}/datanode/delete_block", params={"block_id": block_id}, timeout=3)
+    except Exception as e:
+        print(f" Error eliminando bloque {block_id} en {dn}: {e}")
+
+def promote_live_replicas(live):
+    """Si la copia principal de un bloque está caída y hay una réplica viva, la réplica pasa a principal."""
+    live_set = set(live)
+
+    def needs_promotion(b):
+        locs = block_locations(b)
+        return locs[0] not in live_set and any(u in live_set for u in locs[1:])
+
+    # los registros son copy-on-write: se recorren sin lock y solo se toma
+    # para re-comprobar y actualizar cada bloque candidato
+    candidates = [(fname, b["block_id"]) for fname, rec in list(namespace.items())
+                  for b in rec["blocks"] if needs_promotion(b)]
+    txid = 0
+    for fname, block_id in candidates:
+        with lock:
+            rec = namespace.get(fname)
+            b = next((b for b in rec["blocks"] if b["block_id"] == block_id), None) if rec else None
+            if b is not None and needs_promotion(b):
+                txid = set_locations(fname, block_id, sorted(block_locations(b), key=lambda u: u not in live_set))
+    sync_edits(txid)
+
+def plan_replication(files, live, busy=()):
+    """
+    Decide qué copias hacer. files: [(filename, blocks)], live: datanodes vivos,
+    busy: block_ids con una copia en curso (no se vuelven a planificar).
+    La carga de cada nodo son los bytes de bloques que tiene según los metadatos.
+    Cada bloque recibe como mucho una tarea por pasada.
+    """
+    live_set = set(live)
+    load = {u: 0 for u in live}
+    for _, blocks in files:
+        for b in blocks:
+            for u in block_locations(b):
+                if u in load:
+                    load[u] += b.get("size") or 0
+
+    tasks = []
+    planned = set(busy)
+    want = min(REPLICATION, len(live))
+    for fname, blocks in files:
+        for b in blocks:
+            if not b.get("present") or b.get("corrupt") or b["block_id"] in planned:
+                continue
+            locs = block_locations(b)
+            live_locs = [u for u in locs if u in live_set]
+            candidates = [u for u in live if u not in locs]
+            if not live_locs or len(live_locs) >= want or not candidates:
+                continue
+            target = min(candidates, key=lambda u: load[u])
+            load[target] += b["size"]
+            planned.add(b["block_id"])
+            tasks.append({"kind": "replicate", "filename": fname, "block_id": b["block_id"],
+                          "source": live_locs[0], "target": target, "size": b["size"]})
+
+    if len(live) < 2:
+        return tasks
+    avg = sum(load.values()) / len(live)
+    moves = 0
+    for src in sorted(live, key=lambda u: load[u], reverse=True):
+        if load[src] <= avg * (1 + BALANCE_THRESHOLD) or moves >= REPLICATION_SLOTS:
+            break
+        for fname, blocks in files:
+            for b in blocks:
+                locs = block_locations(b)
+                size = b.get("size") or 0
+                if not b.get("present") or b.get("corrupt") or b["block_id"] in planned \
+                        or src not in locs or size == 0 or size > load[src] - avg:
+                    continue
+                candidates = [u for u in live if u not in locs and load[u] + size <= avg]
+                if not candidates:
+                    continue
+                target = min(candidates, key=lambda u: load[u])
+                load[src] -= size
+                load[target] += size
+                moves += 1
+                planned.add(b["block_id"])
+                tasks.append({"kind": "move", "filename": fname, "block_id": b["block_id"],
+                              "source": src, "target": target, "size": size})
+                if load[src] <= avg * (1 + BALANCE_THRESHOLD) or moves >= REPLICATION_SLOTS:
+                    break
+            else:
+                continue
+            break
+    return tasks
+
+def run_copy(task):
+    """Ejecuta una copia en el DataNode destino y actualiza los metadatos al terminar."""
+    try:
+        mb = task["size"] / (1024 * 1024)
+        timeout = 30 + (mb / REPLICATION_MBPS if REPLICATION_MBPS > 0 else mb)
+        r = requests.post(f"{task['target']}/datanode/copy_from_peer", json={
+            "block_id": task["block_id"],
+            "source_url": task["source"],
+            "mbps": REPLICATION_MBPS
+        }, timeout=timeout)
+        if r.status_code != 200:
+            print(f"Error copiando {task['block_id']} a {task['target']}: {r.text}")
+            return
+        apply_copy(task, r.json())
+    except Exception as e:
+        print(f"Error copiando {task['block_id']} a {task['target']}: {e}")
+    finally:
+        with in_flight_lock:
+            in_flight.discard(task["block_id"])
+
+def apply_copy(task, info):
+    txid = 0
+    with lock:
+        rec = namespace.get(task["filename"])
+        blocks = rec["blocks"] if rec else []
+        b = next((b for b in blocks if b["block_id"] == task["block_id"]), None)
+        ok = b is not None and info["checksum"] == b["checksum"] and task["source"] in block_locations(b)
+        if ok:
+            locs = block_locations(b)
+            if task["kind"] == "move":
+                locs = [task["target"] if u == task["source"] else u for u in locs]
+            else:
+                locs.append(task["target"])
+            txid = set_locations(task["filename"], b["block_id"], list(dict.fromkeys(locs)))
+    sync_edits(txid)
+    if not ok:
+        # el archivo se borró/cambió durante la copia o la copia no coincide: se descarta
+        delete_remote_block(task["target"], task["block_id"])
+        return
+    if task["kind"] == "move":
+        delete_remote_block(task["source"], task["block_id"])
+    print(f"{task['kind']} {task['block_id']}: {task['source']} -> {task['target']}")
+
+def replication_pass():
+    live = sorted(get_active_datanodes(timeout=DEAD_TIMEOUT))
+    if not live:
+        return
+    promote_live_replicas(live)
+    if REPLICATION_SLOTS <= 0:
+        # a este shard no le tocó ninguna copia simultánea: solo actualiza metadatos
+        return
+    # los registros no se modifican en sitio, basta con tomar la lista actual
+    files = [(rec["filename"], rec["blocks"]) for rec in list(namespace.values()) if rec["status"] != "dir"]
+    with in_flight_lock:
+        busy = set(in_flight)
+    for task in plan_replication(files, live, busy):
+        with in_flight_lock:
+            if task["block_id"] in in_flight:
+                continue
+            in_flight.add(task["block_id"])
+        copy_pool.submit(run_copy, task)
+
+def replication_loop():
+    while True:
+        time.sleep(REPLICATION_INTERVAL_SECS)
+        try:
+            replication_pass()
+        except Exception as e:
+            print("Error en re-replicación:", e)
+
+@app.on_event("startup")
+def start_replication():
+    t = threading.Thread(target=replication_loop, daemon=True)
+    t.start()
 
 # --- Endpoints --------------------------------------------------------
 @app.post("/namenode/heartbeat")
 def heartbeat(info: RegInfo):
     """
     Recibe un pulso de vida desde un DataNode y actualiza last_seen.
+    Solo toca la tabla en memoria; flush_liveness lo persiste en lote.
     """
-    with lock:
-        conn = db_conn()
-        c = conn.cursor()
-        now = datetime.utcnow().isoformat()
-        c.execute("UPDATE datanodes SET last_seen=? WHERE url=?", (now, info.datanode_url))
-        conn.commit()
-        conn.close()
+    touch_datanode(info.datanode_url)
     return {"status": "ok", "msg": f"Heartbeat recibido de {info.datanode_url}"}
 
 @app.post("/namenode/register_datanode")
@@ -170,7 +762,7 @@ def register_datanode(info: RegInfo):
     Permite que un DataNode se registre o actualice su información.
     El caller (DataNode) debe enviar datanode_url, capacity y free (opcional).
     """
-    with lock:
+    with dn_lock:
         conn = db_conn()
         c = conn.cursor()
         now = datetime.utcnow().isoformat()
@@ -185,6 +777,7 @@ def register_datanode(info: RegInfo):
         conn.commit()
         datanodes = [r[0] for r in c.execute("SELECT url FROM datanodes").fetchall()]
         conn.close()
+    touch_datanode(info.datanode_url, register=True)
     return {"status": "ok", "datanodes": datanodes}
 
 @app.get("/namenode/list_datanodes")
@@ -197,19 +790,23 @@ def allocate_blocks(req: AllocateReq):
     """
     Asigna bloques para un archivo; usa la lista actual de datanodes registrados.
     La asignación se hace en round-robin sobre la lista de datanodes conocida.
+    Si el cliente envía file_size sin block_size, el tamaño de bloque lo sugiere
+    el NameNode según el tamaño del archivo y los datanodes vivos.
+    Cada bloque guarda su offset y length, así que pueden tener longitudes distintas.
     """
     if not auth_user(req.user, req.password):
         raise HTTPException(status_code=401, detail="Credenciales inválidas")
     
     with lock:
-        conn = db_conn()
-        c = conn.cursor()
-
-        # obtener datanodes activos (last_seen < 60 segundos desde ahora)
-        active_datanodes = get_active_datanodes(conn, timeout=60)
+        # obtener datanodes activos (last_seen < DEAD_TIMEOUT segundos desde ahora);
+        # si ninguno está vivo se usan todos los registrados
+        active_datanodes = sorted(get_active_datanodes(timeout=DEAD_TIMEOUT))
         datanodes = active_datanodes
-        datanode_rows = c.execute("SELECT url FROM datanodes").fetchall() 
-        datanodes = [r[0] for r in datanode_rows]
+        if not datanodes:
+            conn = db_conn()
+            datanode_rows = conn.execute("SELECT url FROM datanodes").fetchall()
+            conn.close()
+            datanodes = [r[0] for r in datanode_rows]
         if not datanodes:
             # si no hay ninguno registrado, fallback a la var de entorno (por compatibilidad)
             env = os.environ.get("DATANODES")
@@ -217,24 +814,26 @@ def allocate_blocks(req: AllocateReq):
                 datanodes = [u.strip() for u in env.split(",") if u.strip()]
 
         if not datanodes:
-            conn.close()
             raise HTTPException(status_code=503, detail="no datanodes available")
 
+        block_size, lengths = plan_blocks(req, len(active_datanodes) or len(datanodes))
+
         # crear entry file si no existe
         now = datetime.utcnow().isoformat()
-        c.execute("INSERT OR IGNORE INTO files(filename, owner, size, block_size, status, created_at, blocks_json) VALUES (?, ?, ?, ?, ?, ?, ?)",
-                  (req.filename, req.user, None, req.block_size or 0, "incomplete", now, "[]"))
-        conn.commit()
 
         allocation = []
         blocks = []
-        for i in range(req.num_blocks):
+        offset = 0
+        for i, length in enumerate(lengths):
             dn = datanodes[i % len(datanodes)]
             block_id = f"{req.filename}__{i}__{uuid.uuid4().hex}"
+            block_offset = offset if length is not None else None
             block_entry = {
                 "block_index": i,
                 "block_id": block_id,
                 "datanode_url": dn,
+                "offset": block_offset,
+                "length": length,
                 "size": 0,
                 "checksum": "",
                 "present": False
@@ -243,58 +842,80 @@ def allocate_blocks(req: AllocateReq):
             allocation.append({
                 "block_index": i,
                 "datanode_url": dn,
-                "block_id": block_id
+                "block_id": block_id,
+                "offset": block_offset,
+                "length": length
             })
+            if length is not None:
+                offset += length
 
-        # guardar en la BD
-        c.execute("UPDATE files SET blocks_json=? WHERE filename=?", (json.dumps(blocks), req.filename))
-        conn.commit()
-        conn.close()
+        # guardar en el namespace (si el archivo ya existía se reemplazan sus bloques)
+        txid = log_edit({"op": "add_blocks", "filename": req.filename, "owner": req.user,
+                         "created_at": now, "block_size": block_size, "blocks": blocks})
+    sync_edits(txid)
 
-    return {"allocation": allocation}
+    return {"allocation": allocation, "block_size": block_size}
 
 @app.post("/namenode/confirm_block")
 def confirm_block(info: ConfirmBlockReq):
     """
     El cliente (o DataNode, según diseño) confirma que un bloque fue almacenado en el DataNode.
-    Actualiza la entrada del bloque en blocks_json y marca 'present'.
+    Actualiza la entrada del bloque en el namespace y marca 'present'.
     """
     if not auth_user(info.user, info.password):
         raise HTTPException(status_code=401, detail="Credenciales inválidas")
 
     with lock:
-        conn = db_conn()
-        c = conn.cursor()
-
-        c.execute("SELECT blocks_json FROM files WHERE filename=?", (info.filename,))
-        row = c.fetchone()
-        if not row:
-            conn.close()
+        rec = namespace.get(info.filename)
+        if not rec:
             raise HTTPException(status_code=404, detail="file not found")
 
-        blocks = json.loads(row[0])
-        updated = False
-        for b in blocks:
-            if b["block_index"] == info.block_index and b["block_id"] == info.block_id:
-                b["size"] = info.size
-                b["checksum"] = info.checksum
-                b["present"] = True
-                updated = True
-                break
-        if not updated:
-            conn.close()
+        b = next((b for b in rec["blocks"]
+                  if b["block_index"] == info.block_index and b["block_id"] == info.block_id), None)
+        if b is None:
             raise HTTPException(status_code=404, detail="block not found")
+        if b.get("length") is not None and b["length"] != info.size:
+            raise HTTPException(status_code=400, detail="block size does not match allocated length")
 
-        all_present = all(b["present"] for b in blocks)
-        total_size = sum(b["size"] for b in blocks)
-
-        status = "available" if all_present else "incomplete"
-        c.execute("UPDATE files SET blocks_json=?, size=?, status=? WHERE filename=?",
-                  (json.dumps(blocks), total_size, status, info.filename))
-        conn.commit()
-        conn.close()
+        # apply_edit marca el bloque y recalcula size/status/offsets del archivo
+        txid = log_edit({"op": "confirm", "filename": info.filename, "block_index": info.block_index,
+                         "size": info.size, "checksum": info.checksum})
+    sync_edits(txid)
     return {"status": "ok"}
 
+@app.post("/namenode/report_corrupt_block")
+def report_corrupt_block(info: CorruptBlockReq):
+    """
+    Un DataNode (su scrubber) reporta que un bloque ya no coincide con su checksum.
+    Si el bloque tiene otras copias, se descarta la corrupta (la re-replicación la repone);
+    si no, se marca el bloque como corrupto y el archivo pasa a status='corrupt'.
+    """
+    with lock:
+        fname, b = find_block(info.block_id, info.datanode_url)
+        if fname is None:
+            raise HTTPException(status_code=404, detail="block not found")
+        others = [u for u in block_locations(b) if u != info.datanode_url]
+        if others:
+            txid = set_locations(fname, b["block_id"], others)
+        else:
+            txid = log_edit({"op": "corrupt", "filename": fname, "block_id": b["block_id"]})
+    sync_edits(txid)
+    print(f"Bloque corrupto {b['block_id']} en {info.datanode_url} ({fname})")
+    if others:
+        delete_remote_block(info.datanode_url, b["block_id"])
+    return {"status": "ok", "filename": fname}
+
+@app.get("/namenode/block_checksum")
+def block_checksum(block_id: str, datanode_url: str):
+    """
+    Checksum esperado de un bloque guardado en `datanode_url`. Lo usa el scrubber
+    para los bloques que no tienen checksum registrado localmente.
+    """
+    fname, b = find_block(block_id, datanode_url)
+    if fname is None or not b.get("checksum"):
+        raise HTTPException(status_code=404, detail="block not found")
+    return {"filename": fname, "block_id": b["block_id"], "checksum": b["checksum"]}
+
 @app.get("/namenode/metadata")
 def get_metadata(filename: str, user: str , password: str ):
     """
@@ -302,23 +923,18 @@ def get_metadata(filename: str, user: str , password: str ):
     """
     if not auth_user(user, password):
         raise HTTPException(status_code=401, detail="Credenciales inválidas")
-    conn = db_conn()
-    c = conn.cursor()
-    c.execute("SELECT filename, owner, size, block_size, status, created_at, blocks_json FROM files WHERE filename=? AND owner=?", (filename, user,))
-    row = c.fetchone()
-    conn.close()
-    if not row:
+    rec = namespace.get(filename)
+    if not rec or rec["owner"] != user:
         raise HTTPException(status_code=404, detail="file not found")
 
-    filename, owner, size, block_size, status, created_at, blocks_json = row
     return {
-        "filename": filename,
-        "owner": owner,
-        "size": size,
-        "block_size": block_size,
-        "status": status,
-        "created_at": created_at,
-        "blocks": json.loads(blocks_json)
+        "filename": rec["filename"],
+        "owner": rec["owner"],
+        "size": rec["size"],
+        "block_size": rec["block_size"],
+        "status": rec["status"],
+        "created_at": rec["created_at"],
+        "blocks": rec["blocks"]
     }
 
 @app.get("/namenode/list_files")
@@ -329,11 +945,8 @@ def list_files( user: str , password: str ):
 
     if not auth_user(user, password):
         raise HTTPException(status_code=401, detail="Credenciales inválidas")
-    conn = db_conn()
-    c = conn.cursor()
-    c.execute("SELECT filename, size, status, created_at FROM files")
-    res = [{"filename":r[0], "size":r[1], "status":r[2], "created_at":r[3]} for r in c.fetchall()]
-    conn.close()
+    res = [{"filename": r["filename"], "size": r["size"], "status": r["status"], "created_at": r["created_at"]}
+           for r in list(namespace.values())]
     return {"files": res}
 
 @app.get("/namenode/ls")
@@ -344,21 +957,12 @@ def list_path(path: str = "/", user: str = "", password: str = ""):
     """
     if not auth_user(user, password):
         raise HTTPException(status_code=401, detail="Credenciales inválidas")
-    conn = db_conn()
-    c = conn.cursor()
-    like_pattern = path.rstrip("/") + "/%"
-    if user:
-        like_pattern = f"{path.rstrip('/')}/%"
-        rows = c.execute("SELECT filename, size, status FROM files WHERE filename LIKE ? AND owner=?", (like_pattern, user)).fetchall()
-    else:
-        rows = c.execute(
-            "SELECT filename, size, status FROM files WHERE filename LIKE ?",
-            (like_pattern,)
-        ).fetchall()
-    conn.close()
+    prefix = path.rstrip("/") + "/"
+    rows = [r for r in list(namespace.values())
+            if r["filename"].startswith(prefix) and (not user or r["owner"] == user)]
     return {
         "files": [
-            {"filename": r[0], "size": r[1], "status": r[2]} for r in rows
+            {"filename": r["filename"], "size": r["size"], "status": r["status"]} for r in rows
         ]
     }
 
@@ -367,40 +971,27 @@ def delete_file(filename: str, user: str , password: str ):
     """
     Elimina un archivo del sistema:
     1. Lee los metadatos y obtiene los bloques.
-    2. Envía request a cada DataNode para borrar los bloques.
-    3. Elimina el registro en la tabla files.
+    2. Elimina el registro del namespace.
+    3. Envía request a cada DataNode para borrar los bloques.
     """
     if not auth_user(user, password):
         raise HTTPException(status_code=401, detail="Credenciales inválidas")
     with lock:
-        conn = db_conn()
-        c = conn.cursor()
-        c.execute("SELECT owner, blocks_json FROM files WHERE filename=?", (filename,))
-        row = c.fetchone()
-        if not row:
-            conn.close()
+        rec = namespace.get(filename)
+        if not rec:
             raise HTTPException(status_code=404, detail="file not found")
 
-        owner, blocks_json = row
-        if owner != user:
-            conn.close()
+        if rec["owner"] != user:
             raise HTTPException(status_code=403, detail="no permission to delete this file")
 
-        blocks = json.loads(blocks_json)
-
-        # borrar bloques en los datanodes
-        for b in blocks:
-            try:
-                dn = b["datanode_url"]
-                block_id = b["block_id"]
-                requests.delete(f"{dn}/datanode/delete_block", params={"block_id": block_id}, timeout=3)
-            except Exception as e:
-                print(f" Error eliminando bloque {block_id} en {dn}: {e}")
-
         # borrar metadatos
-        c.execute("DELETE FROM files WHERE filename=?", (filename,))
-        conn.commit()
-        conn.close()
+        txid = drop_file_record(filename)
+    sync_edits(txid)
+
+    # borrar bloques (y sus réplicas) en los datanodes
+    for b in rec["blocks"]:
+        for dn in block_locations(b):
+            delete_remote_block(dn, b["block_id"])
     return {"status": "ok", "deleted": filename}
 
 
@@ -408,7 +999,7 @@ def delete_file(filename: str, user: str , password: str ):
 def mkdir(req: MkdirReq):
     """
     Crea un directorio lógico.
-    Realmente solo inserta un placeholder en files con status='dir'.
+    Realmente solo inserta un placeholder en el namespace con status='dir'.
     """
     if not auth_user(req.user, req.password):
         raise HTTPException(status_code=401, detail="Credenciales inválidas")
@@ -416,16 +1007,13 @@ def mkdir(req: MkdirReq):
     if not path.startswith("/"):
         raise HTTPException(status_code=400, detail="path must start with /")
 
+    txid = 0
     with lock:
-        conn = db_conn()
-        c = conn.cursor()
         now = datetime.utcnow().isoformat()
         owner = req.user
-        c.execute("""INSERT OR IGNORE INTO files(filename, owner, size, block_size, status, created_at, blocks_json) 
-                 VALUES (?, ?, ?, ?, ?, ?, ?)""",
-              (path.rstrip("/"), owner, 0, 0, "dir", now, "[]"))
-        conn.commit()
-        conn.close()
+        if path.rstrip("/") not in namespace:
+            txid = log_edit({"op": "mkdir", "filename": path.rstrip("/"), "owner": owner, "created_at": now})
+    sync_edits(txid)
     return {"status": "ok", "mkdir": path}
 
 
@@ -437,25 +1025,23 @@ def rmdir(req: RmdirReq):
     if not auth_user(req.user, req.password):
         raise HTTPException(status_code=401, detail="Credenciales inválidas")
     path = req.path
-    prefix = path.rstrip("/") + "/%"
-    with lock:
-        conn = db_conn()
-        c = conn.cursor()
-        rows = c.execute("SELECT filename FROM files WHERE filename LIKE ?", (prefix,)).fetchall()
+    prefix = path.rstrip("/") + "/"
+    rows = [f for f in list(namespace) if f.startswith(prefix)]
 
-        for r in rows:
-            fname = r[0]
-            # llamada recursiva: delete_file
-            try:
-                delete_file(fname)
-            except Exception as e:
-                print(f" Error eliminando {fname}: {e}")
+    for fname in rows:
+        # llamada recursiva: delete_file
+        try:
+            delete_file(fname)
+        except Exception as e:
+            print(f" Error eliminando {fname}: {e}")
 
-        # borrar el propio directorio
-        c.execute("DELETE FROM files WHERE filename=?", (path.rstrip("/"),))
-        conn.commit()
-        conn.close()
-    return {"status": "ok", "rmdir": path, "deleted_files": [r[0] for r in rows]}
+    # borrar el propio directorio
+    txid = 0
+    with lock:
+        if path.rstrip("/") in namespace:
+            txid = drop_file_record(path.rstrip("/"))
+    sync_edits(txid)
+    return {"status": "ok", "rmdir": path, "deleted_files": rows}
 
 @app.post("/namenode/register")
 def register_user(req: UserReq):